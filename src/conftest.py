@@ -1,7 +1,12 @@
+import contextlib
+import fcntl
+import functools
+import hashlib
 import json
 import logging
+import marshal
 import os
-import pickle
+import queue
 import random
 import shlex
 import shutil
@@ -9,17 +14,14 @@ import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-from dataclasses import dataclass
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from typing import Union
 
 import pytest
-from filelock import FileLock
-from sqlalchemy import create_engine
-from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import sessionmaker
-
-from src.db import Invocation, TestResult
 
 logger = logging.getLogger(__name__)
 
@@ -175,6 +177,32 @@ def pytest_addoption(parser: pytest.Parser):
         help="Randomize the order of tests.",
     )
 
+    parser.addoption(
+        "--no-fstests-cache",
+        action="store_true",
+        default=False,
+        help="Rerun mkgroupfile instead of using the cached groups.",
+    )
+    parser.addini(
+        "no_fstests_cache",
+        type="bool",
+        default=False,
+        help="Rerun mkgroupfile instead of using the cached groups.",
+    )
+
+    parser.addoption(
+        "--cache-results",
+        action="store_true",
+        default=False,
+        help="Reuse passing results from the results db for unchanged tests.",
+    )
+    parser.addini(
+        "cache_results",
+        type="bool",
+        default=False,
+        help="Reuse passing results from the results db for unchanged tests.",
+    )
+
     parser.addoption(
         "--results-db-path",
         action="store",
@@ -189,6 +217,73 @@ def pytest_addoption(parser: pytest.Parser):
     )
 
 
+@dataclass(frozen=True, slots=True)
+class Options:
+    num_mkosi: int
+    targetpaths: tuple[str, ...]
+    mkosi_config_dir: Union[str, None]
+    mkosi_options: str
+    mkosi_fstests_dir: Union[str, None]
+    mkosi_setup_timeout: int
+    host_fstests_dir: Union[str, None]
+    tests: tuple[str, ...]
+    excludes: frozenset[str]
+    group: Union[str, None]
+    random: bool
+    no_fstests_cache: bool
+    cache_results: bool
+    results_db_path: Union[str, None]
+
+    @classmethod
+    def from_config(cls, config):
+        if (num_mkosi := config.getoption("--mkosi")) is None:
+            num_mkosi = config.getini("mkosi")
+
+        return cls(
+            num_mkosi=int(num_mkosi) if num_mkosi is not None else 0,
+            targetpaths=tuple(
+                config.getoption("--targetpath") + config.getini("targetpaths")
+            ),
+            mkosi_config_dir=config.getoption("--mkosi-config-dir")
+            or config.getini("mkosi_config_dir"),
+            mkosi_options=" ".join(
+                config.getoption("--mkosi-options")
+                + config.getini("mkosi_options")
+            ),
+            mkosi_fstests_dir=config.getoption("--mkosi-fstests-dir")
+            or config.getini("mkosi_fstests_dir"),
+            mkosi_setup_timeout=int(
+                config.getoption("--mkosi-setup-timeout")
+                or config.getini("mkosi_setup_timeout")
+            ),
+            host_fstests_dir=config.getoption("--host-fstests-dir")
+            or config.getini("host_fstests_dir"),
+            tests=tuple(config.getoption("--tests") + config.getini("tests")),
+            excludes=frozenset(
+                config.getoption("--excludes") + config.getini("excludes")
+            ),
+            group=config.getoption("--group") or config.getini("group"),
+            random=config.getoption("--random") or config.getini("random"),
+            no_fstests_cache=config.getoption("--no-fstests-cache")
+            or config.getini("no_fstests_cache"),
+            cache_results=config.getoption("--cache-results")
+            or config.getini("cache_results"),
+            results_db_path=config.getoption("--results-db-path")
+            or config.getini("results_db_path"),
+        )
+
+
+_options_key = pytest.StashKey[Options]()
+
+
+def __options(config) -> Options:
+    # options are resolved once per process, every helper below reads from
+    # the same snapshot
+    if (options := config.stash.get(_options_key, None)) is None:
+        options = config.stash[_options_key] = Options.from_config(config)
+    return options
+
+
 def __num_machines(config):
     num_mkosis = __num_mkosi(config)
     targetpaths = __targetpaths(config)
@@ -200,11 +295,7 @@ def __num_machines(config):
 
 
 def __num_mkosi(config):
-    if (num := config.getoption("--mkosi")) is not None:
-        return int(num)
-    if (num := config.getini("mkosi")) is not None:
-        return int(num)
-    return 0
+    return __options(config).num_mkosi
 
 
 @pytest.fixture(scope="session")
@@ -213,7 +304,7 @@ def num_mkosi(request):
 
 
 def __targetpaths(config):
-    return config.getoption("--targetpath") + config.getini("targetpaths")
+    return __options(config).targetpaths
 
 
 @pytest.fixture(scope="session")
@@ -222,9 +313,7 @@ def targetpaths(request):
 
 
 def __mkosi_config_dir(config):
-    return config.getoption("--mkosi-config-dir") or config.getini(
-        "mkosi_config_dir"
-    )
+    return __options(config).mkosi_config_dir
 
 
 @pytest.fixture(scope="session")
@@ -233,9 +322,7 @@ def mkosi_config_dir(request):
 
 
 def __mkosi_options(config):
-    return " ".join(
-        config.getoption("--mkosi-options") + config.getini("mkosi_options")
-    )
+    return __options(config).mkosi_options
 
 
 @pytest.fixture(scope="session")
@@ -244,9 +331,7 @@ def mkosi_options(request):
 
 
 def __mkosi_fstests_dir(config):
-    return config.getoption("--mkosi-fstests-dir") or config.getini(
-        "mkosi_fstests_dir"
-    )
+    return __options(config).mkosi_fstests_dir
 
 
 @pytest.fixture(scope="session")
@@ -255,10 +340,7 @@ def mkosi_fstests_dir(request):
 
 
 def __mkosi_setup_timeout(config):
-    return int(
-        config.getoption("--mkosi-setup-timeout")
-        or config.getini("mkosi_setup_timeout")
-    )
+    return __options(config).mkosi_setup_timeout
 
 
 @pytest.fixture(scope="session")
@@ -266,10 +348,26 @@ def mkosi_setup_timeout(request):
     return __mkosi_setup_timeout(request.config)
 
 
+def __host_fstests_dir(config):
+    return __options(config).host_fstests_dir
+
+
+@pytest.fixture(scope="session")
+def host_fstests_dir(request):
+    return __host_fstests_dir(request.config)
+
+
+def __cache_results(config):
+    return __options(config).cache_results
+
+
+@pytest.fixture(scope="session")
+def cache_results(request):
+    return __cache_results(request.config)
+
+
 def __results_db_path(config):
-    return config.getoption("--results-db-path") or config.getini(
-        "results_db_path"
-    )
+    return __options(config).results_db_path
 
 
 @pytest.fixture(scope="session")
@@ -282,46 +380,122 @@ COLLECT TESTS
 """
 
 
-def get_tests_for_(group, fstests_dir_host):
-    def tests_for_(dir, group):
-        proc = subprocess.run(
+def __tests_dir_fingerprint(tests_dir):
+    # mkgroupfile output only changes when a test is added, removed or
+    # edited, all of which bump either the directory or a file mtime
+    fingerprint = os.stat(tests_dir).st_mtime_ns
+    with os.scandir(tests_dir) as entries:
+        for entry in entries:
+            fingerprint = max(fingerprint, entry.stat().st_mtime_ns)
+    return fingerprint
+
+
+def get_tests_for_(group, fstests_dir_host, cache=None, refresh=False):
+    def spawn_mkgroupfile(dir):
+        return subprocess.Popen(
             "../../tools/mkgroupfile",
             cwd=f"{fstests_dir_host}/tests/{dir}",
-            capture_output=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
         )
 
-        if proc.returncode != 0:
+    def parse_mkgroupfile(dir, proc):
+        # index every group at once, so a later run asking for a different
+        # group can be served from the cache too
+        groups = {}
+        # parse as mkgroupfile prints instead of waiting for all of it
+        for line in proc.stdout:
+            if not (fields := line.split()) or line.startswith("#"):
+                continue
+            # match whole group names only, a substring match would also
+            # pick up groups that merely contain the one asked for
+            test, *test_groups = fields
+            for group in test_groups:
+                groups.setdefault(group, []).append(f"{dir}/{test}")
+
+        if proc.wait() != 0:
             raise ValueError("unable to determine tests")
 
-        stdout = proc.stdout.decode()
+        return groups
 
-        for line in stdout.splitlines():
-            if group in line:
-                test = f"{dir}/{line.split()[0]}"
-                if "#" in test:
-                    continue
-                yield test
+    def run_mkgroupfile(dirs):
+        # the directories are independent, let mkgroupfile walk all of
+        # them at once
+        procs = {dir: spawn_mkgroupfile(dir) for dir in dirs}
+        try:
+            return {
+                dir: parse_mkgroupfile(dir, proc)
+                for dir, proc in procs.items()
+            }
+        finally:
+            for proc in procs.values():
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+
+    def groups_for_(dirs):
+        if cache is None:
+            return run_mkgroupfile(dirs)
+
+        keys = {dir: f"fast-fstests/groupfile/{dir}" for dir in dirs}
+        fingerprints = {
+            dir: [
+                fstests_dir_host,
+                __tests_dir_fingerprint(f"{fstests_dir_host}/tests/{dir}"),
+            ]
+            for dir in dirs
+        }
+
+        def cached_groups():
+            groups = {}
+            if refresh:
+                return groups
+            for dir in dirs:
+                cached = cache.get(keys[dir], None)
+                if (
+                    cached is not None
+                    and cached["fingerprint"] == fingerprints[dir]
+                ):
+                    logger.debug("using cached groups for %s", dir)
+                    groups[dir] = cached["groups"]
+            return groups
+
+        if len(groups := cached_groups()) == len(dirs):
+            return groups
+
+        # sessions sharing the cache may collect at the same time, make sure
+        # only one of them runs mkgroupfile and the rest pick up its result
+        lock_path = cache.mkdir("fast-fstests") / "groups.lock"
+        with __flock(lock_path):
+            if len(groups := cached_groups()) == len(dirs):
+                return groups
+
+            missing = [dir for dir in dirs if dir not in groups]
+            for dir, dir_groups in run_mkgroupfile(missing).items():
+                cache.set(
+                    keys[dir],
+                    {"fingerprint": fingerprints[dir], "groups": dir_groups},
+                )
+                groups[dir] = dir_groups
+            return groups
 
     if "/" in group:
         fs_dir, group = group.split("/")
-        return [
-            *tests_for_(fs_dir, group),
-        ]
+        dirs = [fs_dir]
+    else:
+        dirs = ["btrfs", "generic"]
 
-    return [
-        *tests_for_("btrfs", group),
-        *tests_for_("generic", group),
-    ]
+    groups = groups_for_(dirs)
+    return [test for dir in dirs for test in groups[dir].get(group, [])]
 
 
-@pytest.hookimpl
-def pytest_generate_tests(metafunc):
-    group = metafunc.config.getoption("--group") or metafunc.config.getini(
-        "group"
-    )
-    tests = metafunc.config.getoption("--tests") + metafunc.config.getini(
-        "tests"
-    )
+def collect_tests(config):
+    options = __options(config)
+    group = options.group
+    tests = list(options.tests)
 
     if group is None and not tests:
         raise ValueError("no tests specified")
@@ -330,32 +504,53 @@ def pytest_generate_tests(metafunc):
         raise ValueError("cannot specify both suite and tests")
 
     if group:
-        fstests_dir_host = metafunc.config.getoption(
-            "--host-fstests-dir"
-        ) or metafunc.config.getini("host_fstests_dir")
+        fstests_dir_host = options.host_fstests_dir
 
         if not isinstance(fstests_dir_host, str):
             raise ValueError("host-fstests-dir not specified")
 
-        tests = get_tests_for_(group, fstests_dir_host)
+        tests = get_tests_for_(
+            group,
+            fstests_dir_host,
+            getattr(config, "cache", None),
+            refresh=options.no_fstests_cache,
+        )
 
     assert isinstance(tests, list)
 
-    excluded_tests = metafunc.config.getoption(
-        "--excludes"
-    ) + metafunc.config.getini("excludes")
-    tests = [test for test in tests if test not in excluded_tests]
+    if options.excludes:
+        tests = [test for test in tests if test not in options.excludes]
 
-    if len(tests) == 0:
-        raise ValueError("no tests specified")
+    if options.random:
+        # seed with the string itself, it hashes all of it into the seed
+        random.Random(os.environ["RANDOM_SEED"]).shuffle(tests)
+
+    return tests
+
+
+def prefetch_tests(config):
+    # collect on the main process while the machines boot, the workers then
+    # only have to load the list
+    def __prefetch():
+        try:
+            __perform_once(__tmpdir(), "tests", lambda: collect_tests(config))
+        except Exception:
+            # the workers collect again and report the error themselves
+            logger.debug("prefetching tests failed", exc_info=True)
 
-    should_randomize = metafunc.config.getoption(
-        "--random"
-    ) or metafunc.config.getini("random")
+    threading.Thread(target=__prefetch, daemon=True).start()
+
+
+@pytest.hookimpl
+def pytest_generate_tests(metafunc):
+    # the list is built once per session, normally by the main process,
+    # and shared with every worker
+    tests = __perform_once(
+        __tmpdir(), "tests", lambda: collect_tests(metafunc.config)
+    )
 
-    if should_randomize:
-        random.seed(float(os.environ["RANDOM_SEED"]))
-        random.shuffle(tests)
+    if len(tests) == 0:
+        raise ValueError("no tests specified")
 
     metafunc.parametrize("test", tests)
 
@@ -364,7 +559,7 @@ def pytest_generate_tests(metafunc):
 XDIST WORKAROUND
 
 When using pytest-xdist session scoped fixtures run once per process.
-I am leveraging FileLock to ensure that session scoped fixtures are
+I am leveraging flock to ensure that session scoped fixtures are
 only run once.
 """
 
@@ -373,11 +568,28 @@ def __is_main_process():
     return "PYTEST_XDIST_WORKER" not in os.environ
 
 
+@contextlib.contextmanager
+def __flock(path):
+    # blocks in the kernel until the lock is free instead of polling for it
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
 def pytest_configure(config):
     if __is_main_process():
         os.environ["RANDOM_SEED"] = str(random.random())
         os.environ["TMPDIR"] = tempfile.mkdtemp()
 
+        prefetch_tests(config)
+
+        if (results_db_path := __results_db_path(config)) is not None:
+            upgrade_results_db(results_db_path)
+            prefetch_mkosi_metadata(config)
+
     worker_id = os.environ.get("PYTEST_XDIST_WORKER")
     if worker_id is not None:
         logging.basicConfig(
@@ -411,23 +623,34 @@ def root_tmp_dir(tmp_path_factory):
     return tmp_path_factory.getbasetemp().parent
 
 
-@pytest.fixture(scope="session")
-def perform_once(root_tmp_dir):
-    def __perform_once(file_name, perform):
-        file_path = root_tmp_dir / file_name
-        with FileLock(str(file_path) + ".lock"):
-            if file_path.is_file():
-                with open(file_path, "rb") as f:
-                    return pickle.load(f)
+def __perform_once(dir, file_name, perform):
+    file_path = os.path.join(dir, file_name)
+
+    def __load():
+        with open(file_path, "rb") as f:
+            return marshal.load(f)
+
+    # the result is published atomically and never changes afterwards, so
+    # once it exists it can be read without waiting for the lock
+    with contextlib.suppress(FileNotFoundError):
+        return __load()
+
+    with __flock(f"{file_path}.lock"):
+        with contextlib.suppress(FileNotFoundError):
+            return __load()
+
+        res = perform()
 
-            res = perform()
+        with open(f"{file_path}.tmp", "wb") as f:
+            marshal.dump(res, f)
+        os.replace(f"{file_path}.tmp", file_path)
 
-            with open(file_path, "wb") as f:
-                pickle.dump(res, f)
+        return res
 
-            return res
 
-    return __perform_once
+@pytest.fixture(scope="session")
+def perform_once(root_tmp_dir):
+    return functools.partial(__perform_once, root_tmp_dir)
 
 
 """
@@ -435,13 +658,13 @@ MACHINE
 """
 
 
-@dataclass
+@dataclass(frozen=True)
 class MkosiMachine:
     machine_id: str
     pid: int
 
 
-@dataclass
+@dataclass(frozen=True)
 class TargetPathMachine:
     target: str
     path: str
@@ -450,6 +673,24 @@ class TargetPathMachine:
 Machine = Union[MkosiMachine, TargetPathMachine]
 
 
+def machine_to_dict(machine: Machine):
+    if isinstance(machine, MkosiMachine):
+        return {"kind": "mkosi", **asdict(machine)}
+    elif isinstance(machine, TargetPathMachine):
+        return {"kind": "targetpath", **asdict(machine)}
+    raise ValueError("unknown machine type")
+
+
+def machine_from_dict(data) -> Machine:
+    data = dict(data)
+    kind = data.pop("kind")
+    if kind == "mkosi":
+        return MkosiMachine(**data)
+    elif kind == "targetpath":
+        return TargetPathMachine(**data)
+    raise ValueError(f"unknown machine kind {kind}")
+
+
 def setup_mkosi_machine(machine_id, mkosi_config_dir, mkosi_options):
     logger.debug("setting up mkosi machine %s", machine_id)
     proc = subprocess.Popen(
@@ -469,6 +710,17 @@ def setup_mkosi_machine(machine_id, mkosi_config_dir, mkosi_options):
     return MkosiMachine(machine_id, proc.pid)
 
 
+def __is_zombie(pid):
+    # the main process doesn't reap the machine until it exits itself, so
+    # a machine that has terminated still exists as a zombie until then
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name can contain anything, the state follows it
+            return f.read().rpartition(")")[2].split()[0] == "Z"
+    except (OSError, IndexError):
+        return False
+
+
 def cleanup_mkosi_machine(machine: MkosiMachine, mkosi_config_dir):
     logger.debug("sending poweroff %s", machine.machine_id)
     poweroff_status = subprocess.run(
@@ -481,8 +733,8 @@ def cleanup_mkosi_machine(machine: MkosiMachine, mkosi_config_dir):
         ],
         cwd=mkosi_config_dir,
         stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
     ).returncode
 
     logger.debug("poweroff status %d", poweroff_status)
@@ -492,17 +744,15 @@ def cleanup_mkosi_machine(machine: MkosiMachine, mkosi_config_dir):
     try:
         logger.debug("sigterm process %s", machine.machine_id)
         os.kill(machine.pid, signal.SIGTERM)
-        for _ in range(5):
-            try:
-                pid, _ = os.waitpid(machine.pid, os.WNOHANG)
-                if pid != 0:
-                    return
-                time.sleep(1)
-            except ChildProcessError:
-                logger.error(
-                    "something went wrong waiting for machine cleanup %s",
-                    machine.machine_id,
-                )
+        # the machine was spawned by the main process so it can't be
+        # waited on from here, poll until it is gone instead
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if __is_zombie(machine.pid):
+                logger.debug("process terminated %s", machine.machine_id)
+                return
+            os.kill(machine.pid, 0)
+            time.sleep(0.05)
     except ProcessLookupError:
         logger.debug("process already terminated %s", machine.machine_id)
         return
@@ -526,7 +776,9 @@ def wait_for_mkosi_machine(
     mkosi_setup_timeout,
 ):
     logger.debug("waiting for mkosi machine %s...", machine.machine_id)
-    for _ in range(mkosi_setup_timeout):
+    deadline = time.monotonic() + mkosi_setup_timeout
+    delay = 0.1
+    while time.monotonic() < deadline:
         try:
             # check if the pid exists
             os.kill(machine.pid, 0)
@@ -537,77 +789,226 @@ def wait_for_mkosi_machine(
             )
 
         logger.debug("poking machine %s", machine.machine_id)
-        proc = subprocess.run(
+        proc = subprocess.Popen(
             [
                 "mkosi",
                 "--machine",
                 machine.machine_id,
                 "ssh",
-                "echo POKE",
+                "true",
             ],
             cwd=mkosi_config_dir,
             stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
+            # own process group so a hung poke can be killed along with the
+            # ssh mkosi spawned for it
+            start_new_session=True,
         )
-        logger.debug(
-            "machine %s status %d %s %s",
-            machine.machine_id,
-            proc.returncode,
-            proc.stdout.decode(),
-            proc.stderr.decode(),
-        )
+        try:
+            # don't let an ssh that hangs during boot eat the whole setup
+            # timeout
+            _, stderr = proc.communicate(
+                timeout=max(min(deadline - time.monotonic(), 5.0), 0.1)
+            )
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.communicate()
+            logger.debug("poking machine %s timed out", machine.machine_id)
+        else:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "machine %s status %d %s",
+                    machine.machine_id,
+                    proc.returncode,
+                    stderr.decode(),
+                )
 
-        if proc.returncode == 0:
-            return
+            if proc.returncode == 0:
+                return
 
-        time.sleep(1)
+        # back off so fast boots are noticed quickly without poking slow
+        # ones every second
+        time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, 1.0)
 
     raise ValueError("mkosi setup took too long")
 
 
+def wait_for_mkosi_machines(
+    machines: list[MkosiMachine],
+    mkosi_config_dir,
+    mkosi_setup_timeout,
+):
+    if not machines:
+        return
+
+    # the machines boot independently, so poke them all at once rather
+    # than waiting on each in turn
+    with ThreadPoolExecutor(max_workers=len(machines)) as executor:
+        futures = [
+            executor.submit(
+                wait_for_mkosi_machine,
+                machine,
+                mkosi_config_dir,
+                mkosi_setup_timeout,
+            )
+            for machine in machines
+        ]
+        for future in futures:
+            future.result()
+
+
+def __ssh_control_path():
+    return os.path.join(__tmpdir(), "ssh-%C")
+
+
+def setup_targetpath_machine(machine: TargetPathMachine):
+    # open one master connection per target up front, every command run on
+    # the target afterwards is multiplexed over it instead of doing its own
+    # handshake
+    logger.debug("opening ssh master connection to %s", machine.target)
+    # the master stays in the background with ssh's stderr, so a pipe would
+    # never see eof, collect it in a file instead
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        [
+            "ssh",
+            "-M",
+            "-N",
+            "-f",
+            "-o",
+            f"ControlPath={__ssh_control_path()}",
+            machine.target,
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=stderr,
+    )
+    return proc, stderr
+
+
+def wait_for_targetpath_machine(machine: TargetPathMachine, proc, stderr):
+    with stderr:
+        if proc.wait() != 0:
+            # not fatal, ssh falls back to a direct connection without a
+            # master
+            stderr.seek(0)
+            logger.warning(
+                "unable to open ssh master connection to %s: %s",
+                machine.target,
+                stderr.read().decode(errors="replace").strip(),
+            )
+
+
+def cleanup_targetpath_machine(machine: TargetPathMachine):
+    logger.debug("closing ssh master connection to %s", machine.target)
+    subprocess.run(
+        [
+            "ssh",
+            "-O",
+            "exit",
+            "-o",
+            f"ControlPath={__ssh_control_path()}",
+            machine.target,
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def __machine_fstests_dir(machine: Machine, mkosi_fstests_dir):
+    if isinstance(machine, MkosiMachine):
+        if mkosi_fstests_dir is None:
+            raise ValueError("must specify path to fstests for mkosi")
+
+        return mkosi_fstests_dir
+
+    elif isinstance(machine, TargetPathMachine):
+        return machine.path
+    raise ValueError("unknown machine type")
+
+
+@functools.lru_cache
+def __machine_argv(machine: Machine):
+    if isinstance(machine, MkosiMachine):
+        return ("mkosi", "--machine", machine.machine_id, "ssh")
+    elif isinstance(machine, TargetPathMachine):
+        return (
+            "ssh",
+            "-o",
+            f"ControlPath={__ssh_control_path()}",
+            "-o",
+            "ControlMaster=no",
+            machine.target,
+        )
+    raise ValueError("unknown machine type")
+
+
+def run_on_machine(machine: Machine, command, mkosi_config_dir):
+    cmd = [*__machine_argv(machine), command]
+
+    # let ssh write straight to files instead of pumping both pipes through
+    # python while the command runs, fstests output can get large
+    with (
+        tempfile.TemporaryFile() as stdout,
+        tempfile.TemporaryFile() as stderr,
+    ):
+        proc = subprocess.run(
+            cmd,
+            cwd=mkosi_config_dir,
+            stdin=subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=stderr,
+        )
+        stdout.seek(0)
+        stderr.seek(0)
+        proc.stdout = stdout.read()
+        proc.stderr = stderr.read()
+    return proc
+
+
+@pytest.fixture(scope="session")
+def check_command(mkosi_fstests_dir):
+    # the machine is fixed for the worker, so the part of the command that
+    # does not depend on the test only has to be built once
+    machine = __get_machine()
+    fstests_dir = shlex.quote(
+        __machine_fstests_dir(machine, mkosi_fstests_dir)
+    )
+
+    if isinstance(machine, MkosiMachine):
+        return f"cd {fstests_dir} && ./check "
+
+    elif isinstance(machine, TargetPathMachine):
+        return f"cd {fstests_dir} && sudo ./check "
+
+
 @pytest.fixture
 def run_test_(
     mkosi_config_dir,
-    mkosi_fstests_dir,
+    check_command,
+    db_session,
+    test_cache_key,
 ):
     machine = __get_machine()
 
     def __run_test_(test):
-        if isinstance(machine, MkosiMachine):
-            if mkosi_fstests_dir is None:
-                raise ValueError("must specify path to fstests for mkosi")
-
-            proc = subprocess.run(
-                [
-                    "mkosi",
-                    "--machine",
-                    machine.machine_id,
-                    "ssh",
-                    f"cd {mkosi_fstests_dir} ; ./check {test}",
-                ],
-                cwd=mkosi_config_dir,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-
-            return proc.returncode, proc.stdout, proc.stderr
-
-        elif isinstance(machine, TargetPathMachine):
-            proc = subprocess.run(
-                [
-                    "ssh",
-                    machine.target,
-                    f"cd {machine.path} ; sudo ./check {test}",
-                ],
-                cwd=mkosi_config_dir,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
+        if test_cache_key is not None:
+            cached = lookup_cached_result(db_session, test_cache_key)
+            if cached is not None:
+                logger.debug("using cached result for %s", test)
+                stdout, stderr = cached
+                return 0, stdout, stderr
+
+        if check_command is None:
+            return
 
-            return proc.returncode, proc.stdout, proc.stderr
+        proc = run_on_machine(
+            machine, check_command + shlex.quote(test), mkosi_config_dir
+        )
+        return proc.returncode, proc.stdout, proc.stderr
 
     return __run_test_
 
@@ -616,52 +1017,61 @@ def run_test_(
 def pytest_xdist_setupnodes(config):
     num_mkosi = __num_mkosi(config)
     targetpaths = __targetpaths(config)
+    mkosi_config_dir = __mkosi_config_dir(config)
+    mkosi_options = __mkosi_options(config)
     id = 0
 
-    for _ in range(num_mkosi):
+    machines = {}
+    mkosi_machines = []
+    if num_mkosi > 0:
+        with ThreadPoolExecutor(max_workers=num_mkosi) as executor:
+            mkosi_machines = list(
+                executor.map(
+                    lambda worker_id: setup_mkosi_machine(
+                        worker_id, mkosi_config_dir, mkosi_options
+                    ),
+                    [f"gw{id + i}" for i in range(num_mkosi)],
+                )
+            )
+
+    for machine in mkosi_machines:
         worker_id = f"gw{id}"
         id += 1
 
-        machine = setup_mkosi_machine(
-            worker_id, __mkosi_config_dir(config), __mkosi_options(config)
-        )
-
-        with open(os.path.join(__tmpdir(), worker_id), "wb") as f:
-            pickle.dump(machine, f)
+        machines[worker_id] = machine
 
+    targetpath_machines = []
     for targetpath in targetpaths:
         worker_id = f"gw{id}"
         id += 1
 
         machine = TargetPathMachine(*targetpath.split(":"))
+        targetpath_machines.append(
+            (machine, *setup_targetpath_machine(machine))
+        )
 
-        with open(os.path.join(__tmpdir(), worker_id), "wb") as f:
-            pickle.dump(machine, f)
+        machines[worker_id] = machine
 
+    __save_machines(machines)
 
-@pytest.hookimpl
-def pytest_configure_node(node):
-    worker_id = node.gateway.id
-    if worker_id is None:
-        return
+    wait_for_mkosi_machines(
+        mkosi_machines, mkosi_config_dir, __mkosi_setup_timeout(config)
+    )
 
-    with open(os.path.join(__tmpdir(), worker_id), "rb") as f:
-        machine: Machine = pickle.load(f)
+    for machine, proc, stderr in targetpath_machines:
+        wait_for_targetpath_machine(machine, proc, stderr)
 
-    if isinstance(machine, MkosiMachine):
-        wait_for_mkosi_machine(
-            machine,
-            __mkosi_config_dir(node.config),
-            __mkosi_setup_timeout(node.config),
-        )
-
-    elif isinstance(machine, TargetPathMachine):
-        pass
+    # by now the machines have booted, so this should not wait at all
+    wait_for_mkosi_metadata()
 
 
 @pytest.hookimpl
 def pytest_sessionfinish(session):
     if __is_main_process():
+        for targetpath in __targetpaths(session.config):
+            cleanup_targetpath_machine(
+                TargetPathMachine(*targetpath.split(":"))
+            )
         shutil.rmtree(__tmpdir())
     else:
         machine = __get_machine()
@@ -669,19 +1079,38 @@ def pytest_sessionfinish(session):
             cleanup_mkosi_machine(machine, __mkosi_config_dir(session.config))
 
 
+# TMPDIR is set once by the main process before the workers are spawned and
+# never changes afterwards
+@functools.lru_cache(maxsize=1)
 def __tmpdir():
     if (tmpdir := os.environ.get("TMPDIR")) is None:
         raise ValueError("no tmp dir")
     return tmpdir
 
 
-def __get_machine():
+def __save_machines(machines: dict[str, Machine]):
+    path = os.path.join(__tmpdir(), "machines.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(
+            {
+                worker_id: machine_to_dict(machine)
+                for worker_id, machine in machines.items()
+            },
+            f,
+        )
+    os.replace(f"{path}.tmp", path)
+    __get_machine.cache_clear()
+
+
+# a worker keeps the same machine for the whole session, so only load it
+# the first time it is asked for
+@functools.lru_cache(maxsize=1)
+def __get_machine() -> Machine:
     if (worker_id := os.environ.get("PYTEST_XDIST_WORKER")) is None:
         raise ValueError("no worker_id found")
 
-    with open(os.path.join(__tmpdir(), worker_id), "rb") as f:
-        machine = pickle.load(f)
-        return machine
+    with open(os.path.join(__tmpdir(), "machines.json")) as f:
+        return machine_from_dict(json.load(f)[worker_id])
 
 
 """
@@ -689,68 +1118,227 @@ RESULTS DB
 """
 
 
+def upgrade_results_db(results_db_path):
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import OperationalError
+
+    from src.db import upgrade
+
+    # upgrade once before the workers start instead of every worker racing
+    # to alter the same tables
+    engine = create_engine(
+        f"sqlite:///{results_db_path}", connect_args={"timeout": 30}
+    )
+    try:
+        upgrade(engine)
+    except OperationalError:
+        logger.exception("failed to upgrade results db")
+    finally:
+        engine.dispose()
+
+
 @pytest.fixture(scope="session")
 def db_sessionmaker(results_db_path):
     if results_db_path is None:
         return
-    engine = create_engine(f"sqlite:///{results_db_path}")
+
+    # sqlalchemy is only needed with a results db, don't make every worker
+    # pay for importing it otherwise
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+
+    # with many workers committing at once a writer can wait longer than
+    # sqlite's default 5s for the lock, wait rather than drop the result
+    engine = create_engine(
+        f"sqlite:///{results_db_path}", connect_args={"timeout": 30}
+    )
+
+    @event.listens_for(engine, "connect")
+    def __set_sqlite_pragmas(dbapi_connection, _):
+        # every worker writes to the same db, WAL keeps them from blocking
+        # each other and NORMAL skips the fsync on every commit
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
     return sessionmaker(bind=engine)
 
 
 @pytest.fixture(scope="session")
-def get_pytest_options(pytestconfig, perform_once):
-    def __pytest_options():
-        return json.dumps(pytestconfig.inicfg)
+def db_session(db_sessionmaker):
+    if db_sessionmaker is None:
+        yield None
+        return
 
-    return perform_once("pytest_options.pkl", __pytest_options)
+    with db_sessionmaker() as session:
+        yield session
 
 
 @pytest.fixture(scope="session")
-def get_pytest_invocation(pytestconfig, perform_once):
-    def __pytest_invocation():
-        return json.dumps(pytestconfig.invocation_params.args)
-
-    return perform_once("pytest_invocation.pkl", __pytest_invocation)
+def get_pytest_options(pytestconfig):
+    # only read by the worker that records the invocation, serializing it
+    # is cheaper than sharing it through perform_once
+    return json.dumps(pytestconfig.inicfg)
 
 
 @pytest.fixture(scope="session")
-def mkosi_version(perform_once):
-    def __mkosi_version():
-        return subprocess.run(
-            ["mkosi", "--version"], capture_output=True
-        ).stdout.decode()
+def get_pytest_invocation(pytestconfig):
+    return json.dumps(pytestconfig.invocation_params.args)
+
+
+def get_mkosi_version():
+    return subprocess.run(
+        ["mkosi", "--version"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ).stdout.decode()
+
+
+def get_mkosi_config(mkosi_config_dir, mkosi_options):
+    env = os.environ.copy()
+    env["PAGER"] = "cat"
+    return subprocess.run(
+        ["mkosi", *(shlex.split(mkosi_options)), "cat-config"],
+        cwd=mkosi_config_dir,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+    ).stdout.decode()
+
+
+def __mkosi_config_fingerprint(mkosi_version, mkosi_config_dir, mkosi_options):
+    # without a config dir mkosi runs from wherever pytest was started,
+    # which also holds logs and results, don't try to track that
+    if mkosi_config_dir is None or not mkosi_version:
+        return None
+
+    # cat-config only changes when mkosi or something in the config tree
+    # does, skip the build state mkosi keeps next to it
+    config_dir = os.path.abspath(mkosi_config_dir)
+    fingerprint = 0
+    for root, dirs, files in os.walk(config_dir):
+        dirs[:] = [
+            dir
+            for dir in dirs
+            if not dir.startswith(".")
+            and dir
+            not in (
+                "mkosi.builddir",
+                "mkosi.cache",
+                "mkosi.output",
+                "mkosi.tools",
+                "mkosi.workspace",
+            )
+        ]
+        for name in [root, *(os.path.join(root, file) for file in files)]:
+            try:
+                fingerprint = max(fingerprint, os.stat(name).st_mtime_ns)
+            except OSError:
+                pass
+    return [mkosi_version, config_dir, mkosi_options, fingerprint]
+
+
+_mkosi_metadata_futures = []
+
 
-    return perform_once("mkosi_version.pkl", __mkosi_version)
+def prefetch_mkosi_metadata(config):
+    cache = getattr(config, "cache", None)
+    mkosi_config_dir = __mkosi_config_dir(config)
+    mkosi_options = __mkosi_options(config)
+
+    def __get_mkosi_config(mkosi_version):
+        # cat-config is slow, skip it when neither mkosi nor its config
+        # changed since the last session
+        key = "fast-fstests/mkosi/mkosi_config"
+        if (
+            cache is None
+            or (
+                key_fingerprint := __mkosi_config_fingerprint(
+                    mkosi_version, mkosi_config_dir, mkosi_options
+                )
+            )
+            is None
+        ):
+            return get_mkosi_config(mkosi_config_dir, mkosi_options)
+
+        cached = cache.get(key, None)
+        if cached is not None and cached["fingerprint"] == key_fingerprint:
+            logger.debug("using cached mkosi_config")
+            return cached["value"]
+
+        res = get_mkosi_config(mkosi_config_dir, mkosi_options)
+        cache.set(key, {"fingerprint": key_fingerprint, "value": res})
+        return res
+
+    def __fetch(file_name, perform, *args):
+        try:
+            res = perform(*args)
+        except Exception:
+            # the metadata is only informational, don't fail the session
+            # over it
+            logger.exception("failed to get %s", file_name)
+            res = ""
+
+        with open(os.path.join(__tmpdir(), file_name), "wb") as f:
+            marshal.dump(res, f)
+        return res
+
+    # query mkosi in the background while the machines boot instead of
+    # blocking the first test of the session on it. the version is
+    # recorded for provenance, so always ask the mkosi that is installed
+    # rather than trusting anything about the binary on PATH
+    def __prefetch():
+        mkosi_version = __fetch("mkosi_version", get_mkosi_version)
+        __fetch("mkosi_config", __get_mkosi_config, mkosi_version)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    _mkosi_metadata_futures.append(executor.submit(__prefetch))
+    executor.shutdown(wait=False)
+
+
+def wait_for_mkosi_metadata():
+    for future in _mkosi_metadata_futures:
+        future.result()
+
+
+def __load_mkosi_metadata(file_name):
+    with open(os.path.join(__tmpdir(), file_name), "rb") as f:
+        return marshal.load(f)
 
 
 @pytest.fixture(scope="session")
-def mkosi_config(mkosi_config_dir, mkosi_options, perform_once):
-    def __mkosi_config():
-        env = os.environ.copy()
-        env["PAGER"] = "cat"
-        return subprocess.run(
-            ["mkosi", *(shlex.split(mkosi_options)), "cat-config"],
-            cwd=mkosi_config_dir,
-            capture_output=True,
-            env=env,
-        ).stdout.decode()
+def mkosi_version():
+    return __load_mkosi_metadata("mkosi_version")
 
-    return perform_once("mkosi_config.pkl", __mkosi_config)
+
+@pytest.fixture(scope="session")
+def mkosi_config():
+    return __load_mkosi_metadata("mkosi_config")
 
 
 @pytest.fixture(scope="session", autouse=True)
 def invocation_id(
-    db_sessionmaker,
+    request: pytest.FixtureRequest,
+    db_session,
     get_pytest_options,
     get_pytest_invocation,
-    mkosi_version,
-    mkosi_config,
     perform_once,
 ):
-    if db_sessionmaker is None:
+    if db_session is None:
         return
 
+    mkosi_version = request.getfixturevalue("mkosi_version")
+    mkosi_config = request.getfixturevalue("mkosi_config")
+
     def __record_invocation():
+        from sqlalchemy.exc import OperationalError
+
+        from src.db import Invocation
+
         invocation = Invocation(
             timestamp=int(time.time()),
             python_version=sys.version,
@@ -762,19 +1350,211 @@ def invocation_id(
         )
 
         try:
-            with db_sessionmaker() as session:
-                session.add(invocation)
-                session.commit()
-                return invocation.id
+            db_session.add(invocation)
+            db_session.commit()
+            return invocation.id
         except OperationalError:
+            db_session.rollback()
             logger.exception("failed to record invocation")
 
-    return perform_once("invocation_id.pkl", __record_invocation)
+    return perform_once("invocation_id", __record_invocation)
+
+
+@pytest.fixture(scope="session")
+def fstests_fingerprint(
+    request: pytest.FixtureRequest,
+    mkosi_config_dir,
+    mkosi_options,
+    mkosi_fstests_dir,
+):
+    machine = __get_machine()
+    fstests_dir = __machine_fstests_dir(machine, mkosi_fstests_dir)
+
+    # a result depends on the kernel and on the fstests tree the machine
+    # actually runs, not on the copy on the host, so hash it over there
+    proc = run_on_machine(
+        machine,
+        "cat /proc/version && "
+        f"cd {shlex.quote(fstests_dir)} && "
+        "find check common local.config tests -type f -print0 2>/dev/null "
+        "| sort -z | xargs -0 sha256sum",
+        mkosi_config_dir,
+    )
+    if proc.returncode != 0:
+        logger.warning("unable to fingerprint fstests, not caching")
+        return None
+
+    kernel, *files = proc.stdout.decode().splitlines()
+
+    # the same kernel and tree can still run a test under different
+    # options, or on a different target
+    if isinstance(machine, MkosiMachine):
+        run_config = [
+            "mkosi",
+            mkosi_options,
+            request.getfixturevalue("mkosi_config"),
+        ]
+    else:
+        run_config = ["targetpath", machine.target, machine.path]
+
+    setup = hashlib.sha256(json.dumps([kernel, *run_config]).encode())
+    tests = {}
+    for line in files:
+        _, path = line.split(maxsplit=1)
+        if path.startswith("tests/"):
+            # group the test with its .out and any other files named after
+            # it
+            test = path.removeprefix("tests/").partition(".")[0]
+            tests.setdefault(test, []).append(line)
+        else:
+            setup.update(f"{line}\n".encode())
+
+    return setup.hexdigest(), tests
+
+
+@pytest.fixture(scope="function")
+def test_cache_key(
+    request: pytest.FixtureRequest,
+    cache_results,
+    db_session,
+):
+    if not cache_results or db_session is None:
+        return None
+
+    fingerprint = request.getfixturevalue("fstests_fingerprint")
+    if fingerprint is None:
+        return None
+
+    setup, tests = fingerprint
+    test = request.getfixturevalue("test")
+    key = hashlib.sha256(f"{setup}\0{test}".encode())
+    for line in tests.get(test, []):
+        key.update(f"{line}\n".encode())
+
+    return key.hexdigest()
+
+
+def lookup_cached_result(db_session, cache_key):
+    from sqlalchemy import select
+    from sqlalchemy.exc import OperationalError
+
+    from src.db import TestResult
+
+    try:
+        cached = db_session.scalars(
+            select(TestResult)
+            .where(TestResult.cache_key == cache_key)
+            .where(TestResult.status == "pass")
+            .order_by(TestResult.timestamp.desc())
+            .limit(1)
+        ).first()
+        if cached is None:
+            return None
+        return (
+            cached.stdout_blob.contents() if cached.stdout_blob else b"",
+            cached.stderr_blob.contents() if cached.stderr_blob else b"",
+        )
+    except OperationalError:
+        db_session.rollback()
+        logger.exception("failed to look up cached result")
+
+
+def make_blob(data):
+    # most tests print nothing to stderr, don't store anything for that
+    if not data:
+        return None, None
+
+    # fstests output repeats a lot between tests, so store each distinct
+    # output once and reference it by hash
+    sha256 = hashlib.sha256(data).hexdigest()
+    return sha256, {
+        "sha256": sha256,
+        "compression": "zlib",
+        "data": zlib.compress(data, 1),
+    }
+
+
+@pytest.fixture(scope="session")
+def result_writer(db_sessionmaker):
+    if db_sessionmaker is None:
+        yield None
+        return
+
+    from sqlalchemy import insert
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+    from sqlalchemy.exc import OperationalError
+
+    from src.db import Blob, TestResult
+
+    # writing a result means hashing, compressing and committing its
+    # output, do that off the test's thread so the next test can start
+    results = queue.Queue()
+
+    def __next_batch():
+        # commit everything that queued up while the last commit was running
+        # in one transaction instead of paying for a commit per result
+        batch = [results.get()]
+        while batch[-1] is not None:
+            try:
+                batch.append(results.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def __write_results():
+        with db_sessionmaker() as session:
+            done = False
+            while not done:
+                batch = __next_batch()
+                if batch[-1] is None:
+                    batch.pop()
+                    done = True
+
+                if not batch:
+                    continue
+
+                # results are append only, insert them as plain rows instead
+                # of going through the orm unit of work
+                blobs = {}
+                test_results = []
+                for test_result, stdout, stderr in batch:
+                    for column, data in (
+                        ("stdout_hash", stdout),
+                        ("stderr_hash", stderr),
+                    ):
+                        sha256, blob = make_blob(data)
+                        test_result[column] = sha256
+                        if blob is not None:
+                            blobs[sha256] = blob
+                    test_results.append(test_result)
+
+                try:
+                    if blobs:
+                        session.execute(
+                            sqlite_insert(Blob).on_conflict_do_nothing(),
+                            list(blobs.values()),
+                        )
+                    session.execute(insert(TestResult), test_results)
+                    session.commit()
+                except OperationalError:
+                    session.rollback()
+                    logger.exception("failed to record %d tests", len(batch))
+
+    writer = threading.Thread(target=__write_results, daemon=True)
+    writer.start()
+
+    yield results.put
+
+    results.put(None)
+    writer.join()
 
 
 @pytest.fixture(scope="function")
 def record_test(
-    db_sessionmaker, request: pytest.FixtureRequest, invocation_id
+    result_writer,
+    request: pytest.FixtureRequest,
+    invocation_id,
+    test_cache_key,
 ):
 
     status = None
@@ -801,24 +1581,18 @@ def record_test(
     if status is None:
         return
 
-    if db_sessionmaker is None:
+    if result_writer is None:
         return
 
-    test_result = TestResult(
-        invocation_id=invocation_id,
-        timestamp=int(time.time()),
-        name=request.node.funcargs["test"],
-        time=end - start,
-        status=status,
-        return_code=return_code,
-        summary=summary,
-        stdout=stdout,
-        stderr=stderr,
-    )
-
-    try:
-        with db_sessionmaker() as session:
-            session.add(test_result)
-            session.commit()
-    except OperationalError:
-        logger.exception("failed to record test")
+    test_result = {
+        "invocation_id": invocation_id,
+        "timestamp": int(time.time()),
+        "name": request.node.funcargs["test"],
+        "time": end - start,
+        "status": status,
+        "return_code": return_code,
+        "summary": summary,
+        "cache_key": test_cache_key,
+    }
+
+    result_writer((test_result, stdout, stderr))
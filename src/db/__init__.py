@@ -1,5 +1,17 @@
-from sqlalchemy import Column, Float, ForeignKey, Integer, Text
-from sqlalchemy.orm import declarative_base
+import zlib
+
+from sqlalchemy import (
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    Text,
+    text,
+)
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.schema import CreateIndex, CreateTable
 
 Base = declarative_base()
 
@@ -18,8 +30,34 @@ class Invocation(Base):
     mkosi_config = Column(Text)
 
 
+class Blob(Base):
+    __tablename__ = "blobs"
+
+    sha256 = Column(Text, primary_key=True)
+    compression = Column(Text)
+    data = Column(LargeBinary)
+
+    def contents(self):
+        if self.compression == "zlib":
+            return zlib.decompress(self.data)
+        return self.data
+
+
 class TestResult(Base):
     __tablename__ = "test_results"
+    __table_args__ = (
+        Index("ix_test_results_invocation_name", "invocation_id", "name"),
+        Index(
+            "ix_test_results_status",
+            "status",
+            sqlite_where=text("status != 'pass'"),
+        ),
+        Index(
+            "ix_test_results_cache_key",
+            "cache_key",
+            sqlite_where=text("cache_key IS NOT NULL"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     invocation_id = Column(Integer, ForeignKey("invocations.id"))
@@ -30,5 +68,48 @@ class TestResult(Base):
     status = Column(Text)
     return_code = Column(Integer)
     summary = Column(Text)
+    # output used to be stored inline, these are only set on results
+    # recorded before the blobs table existed
     stdout = Column(Text)
     stderr = Column(Text)
+    stdout_hash = Column(Text, ForeignKey("blobs.sha256"))
+    stderr_hash = Column(Text, ForeignKey("blobs.sha256"))
+    cache_key = Column(Text)
+
+    stdout_blob = relationship(Blob, foreign_keys=[stdout_hash])
+    stderr_blob = relationship(Blob, foreign_keys=[stderr_hash])
+
+
+# columns added to test_results since it was first created, and the
+# definitions to add them to an existing db with
+_added_test_results_columns = {
+    "stdout_hash": "TEXT REFERENCES blobs(sha256)",
+    "stderr_hash": "TEXT REFERENCES blobs(sha256)",
+    "cache_key": "TEXT",
+}
+
+
+def upgrade(engine):
+    """Bring a results db created by an older setup_db.py up to date."""
+    with engine.begin() as connection:
+        connection.execute(CreateTable(Blob.__table__, if_not_exists=True))
+
+        columns = {
+            row[1]
+            for row in connection.exec_driver_sql(
+                "PRAGMA table_info(test_results)"
+            )
+        }
+        # setup_db.py was never run on this db, there is nothing to upgrade
+        if not columns:
+            return
+
+        for name, definition in _added_test_results_columns.items():
+            if name not in columns:
+                connection.exec_driver_sql(
+                    f"ALTER TABLE test_results ADD COLUMN {name} {definition}"
+                )
+
+        # the indexes cover the added columns, so create them last
+        for index in TestResult.__table__.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
@@ -1,33 +1,33 @@
-import re
-
 import pytest
 
 
+# check output can be large, search the raw bytes and only decode the part
+# that ends up in the summary
 def summarize_stdout(test, stdout):
-    start_token = test
-    end_token = f"Ran: {test}"
-    summary_pattern = re.compile(
-        rf"{re.escape(start_token)}(.*?){re.escape(end_token)}",
-        re.DOTALL,
-    )
-    match = summary_pattern.search(stdout)
-    return f"{match.group(1).strip()}" if match else stdout
+    start_token = test.encode()
+    end_token = f"Ran: {test}".encode()
+    start = stdout.find(start_token)
+    if start < 0:
+        return stdout.decode()
+    start += len(start_token)
+    end = stdout.find(end_token, start)
+    return stdout[start:end].strip().decode() if end >= 0 else stdout.decode()
 
 
 def summarize_stdout_skip(stdout):
-    skip_token = "[not run]"
-    reason_pattern = re.compile(rf"{re.escape(skip_token)}(.*)")
-    match = reason_pattern.search(stdout)
-    return match.group(1).strip() if match else stdout
+    skip_token = b"[not run]"
+    start = stdout.find(skip_token)
+    if start < 0:
+        return stdout.decode()
+    start += len(skip_token)
+    end = stdout.find(b"\n", start)
+    return stdout[start : end if end >= 0 else len(stdout)].strip().decode()
 
 
 def test(test, run_test_, record_test):
     status, stdout, stderr = run_test_(test)
 
-    stdout = stdout.decode()
-    stderr = stderr.decode()
-
-    skip_token = "[not run]"
+    skip_token = b"[not run]"
     if skip_token in stdout:
         summary = summarize_stdout_skip(stdout)
         record_test("skip", status, summary, stdout, stderr)
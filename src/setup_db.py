@@ -1,5 +1,5 @@
 from py import sys
-from db import Base
+from db import Base, upgrade
 from sqlalchemy import create_engine
 
 if __name__ == "__main__":
@@ -9,3 +9,4 @@ if __name__ == "__main__":
 
     engine = create_engine(f"sqlite:///{db_path}")
     Base.metadata.create_all(engine)
+    upgrade(engine)